@@ -1,164 +1,576 @@
 #!/usr/bin/env python3
 import os
 
-from statistics import mean
-import urllib.parse
+import math
+import operator
+from statistics import fmean
 import time
-import requests
 import sys
 import json
+from array import array
 from collections import deque
-from scipy.stats import linregress
+from contextlib import AsyncExitStack, contextmanager
+from dataclasses import dataclass, fields
 import argparse
-import subprocess
+import asyncio
+
+import aiohttp
+import msgspec
 
 def log_error(message, quiet):
     if not quiet:
         print(f"[ERROR] {message}", file=sys.stderr)
 
-OUTPUT_DIR = "/home/pi/ratemeter"
-FILE_SHORTTERM = f"{OUTPUT_DIR}/shortterm"
-FILE_SMOOTHED = f"{OUTPUT_DIR}/smoothed"
-FILE_LONGTERM = f"{OUTPUT_DIR}/longterm"
-FILE_MIDTERM = f"{OUTPUT_DIR}/midterm"
+@dataclass(slots=True)
+class Config:
+    """Daemon settings. The defaults match the printer's Pi; --config overrides them from JSON."""
+    output_dir: str = "/home/pi/ratemeter"
+    host: str = "http://localhost"
+    influx_helper: str = "/home/pi/devs/zhopper/influx_write_by_line.py"
+    influx_bucket: str = "gantry"
+    influx_measurement: str = "gantry"
+    # Keep one helper running with --stdin-loop and feed it records on stdin,
+    # instead of running it once per record. Needs a helper with that flag.
+    influx_stdin_loop: bool = False
+    interval: float = 1  # seconds
+    samples_shortterm: int = 60  # number of samples to use for calculating a rate
+    samples_midterm: int = 120  # number of samples to use for mid-term rate
+    samples_longterm: int = 240  # number of samples to use for long-term rate
+    number_of_rates: int = 20  # number of calculated short-term rates to average
+    log: bool = False
+    influxdb: bool = False
+    quiet: bool = False
+    # Write all four rates to a single "status" file (shortterm, midterm,
+    # longterm, smoothed; one 10-byte line each) instead of four files.
+    combined_output: bool = False
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise TypeError("expected a JSON object")
+        types = {field.name: field.type for field in fields(cls)}
+        for name, value in data.items():
+            expected = types.get(name)
+            if expected is None:
+                raise TypeError(f"unknown setting {name!r}")
+            # JSON has no separate int type for floats, but a bool is never a number here
+            if expected is float and isinstance(value, int) and not isinstance(value, bool):
+                data[name] = value = float(value)
+            if type(value) is not expected:
+                raise TypeError(f"{name} must be of type {expected.__name__}, not {json.dumps(value)}")
+        config = cls(**data)
+        if config.interval <= 0:
+            raise ValueError("interval must be positive")
+        for name in ("samples_shortterm", "samples_midterm", "samples_longterm", "number_of_rates"):
+            if getattr(config, name) < 1:
+                raise ValueError(f"{name} must be at least 1")
+        # Rates are only written once the long-term window has 5 samples, and
+        # the sample ring and stall cutoff are sized from the long-term window.
+        if not config.samples_shortterm <= config.samples_midterm <= config.samples_longterm:
+            raise ValueError("need samples_shortterm <= samples_midterm <= samples_longterm")
+        if config.samples_longterm < 5:
+            raise ValueError("samples_longterm must be at least 5")
+        return config
+
+    def output_file(self, name):
+        return os.path.join(self.output_dir, name)
+
+
+def window_sums(ts, ds):
+    """Return (Σt, Σd, Σt², Σd², Σtd) of two equal-length float sequences."""
+    # Only used by RollingRegression._resync(), once every 10 * window ticks, so
+    # speed barely matters; sum() over map() is simply the shortest way to write it.
+    return (sum(ts), sum(ds),
+            sum(map(operator.mul, ts, ts)),
+            sum(map(operator.mul, ds, ds)),
+            sum(map(operator.mul, ts, ds)))
+
+
+class SampleRing:
+    """The most recent (timestamp, distance) samples as two parallel arrays of doubles.
+
+    Each sample is stored twice, at slot i and i + capacity, so the newest n
+    samples are always one contiguous slice and windows can be handed out as
+    memoryviews without copying.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._t = array("d", bytes(16 * capacity))  # 2 * capacity doubles
+        self._d = array("d", bytes(16 * capacity))
+        self._t_view = memoryview(self._t)
+        self._d_view = memoryview(self._d)
+        self._head = 0  # slot the next sample is written to
+
+    def append(self, t, d):
+        i = self._head
+        self._t[i] = self._t[i + self.capacity] = t
+        self._d[i] = self._d[i + self.capacity] = d
+        self._head = (i + 1) % self.capacity
+
+    def sample(self, age):
+        """Return the sample appended `age` appends ago (0 is the newest)."""
+        i = self._head + self.capacity - 1 - age
+        return self._t[i], self._d[i]
+
+    def window(self, n):
+        """Return views of the timestamps and distances of the newest n samples, oldest first."""
+        end = self._head + self.capacity
+        return self._t_view[end - n:end], self._d_view[end - n:end]
+
+
+class RollingRegression:
+    """Least-squares fit of distance over time for the newest `window` samples of a ring.
+
+    Instead of refitting the whole window every tick, the sums needed for the
+    slope are updated in O(1) as samples enter and leave the window. The sums
+    are kept relative to an origin sample so that squared timestamps do
+    not swamp them, and are rebuilt from the window every 10 * window updates
+    so floating-point drift cannot accumulate. The ring must hold at least
+    window + 1 samples, so the one leaving the window can still be read.
+    """
+
+    def __init__(self, samples, window):
+        self.window = window
+        self._samples = samples
+        self._n = 0  # number of ring samples currently in the window
+        self._resync_interval = 10 * window
+        self._until_resync = self._resync_interval
+        self._reset(0.0, 0.0)
+
+    def __len__(self):
+        return self._n
+
+    def _reset(self, t0, d0):
+        self._t0 = t0
+        self._d0 = d0
+        self._s_t = self._s_d = self._s_tt = self._s_dd = self._s_td = 0.0
+
+    def _accumulate(self, t, d, sign):
+        t -= self._t0
+        d -= self._d0
+        self._s_t += sign * t
+        self._s_d += sign * d
+        self._s_tt += sign * t * t
+        self._s_dd += sign * d * d
+        self._s_td += sign * t * d
+
+    def _resync(self):
+        self._until_resync = self._resync_interval
+        ts, ds = self._samples.window(self._n)
+        self._reset(ts[0], ds[0])
+        # Shifting to the origin before summing keeps the squares small. Summing the
+        # raw views and shifting afterwards would save these two list passes, but
+        # it cancels badly once the daemon has been up for a long time.
+        self._s_t, self._s_d, self._s_tt, self._s_dd, self._s_td = window_sums(
+            [t - self._t0 for t in ts], [d - self._d0 for d in ds])
+
+    def update(self):
+        """Take in the newest sample of the ring, dropping the oldest once the window is full."""
+        t, d = self._samples.sample(0)
+        if not self._n:
+            self._reset(t, d)
+        if self._n == self.window:
+            self._accumulate(*self._samples.sample(self.window), -1)
+        else:
+            self._n += 1
+        self._accumulate(t, d, 1)
+        self._until_resync -= 1
+        if not self._until_resync:
+            self._resync()
+
+    def evict_before(self, cutoff):
+        while self._n:
+            t, d = self._samples.sample(self._n - 1)
+            if t >= cutoff:
+                break
+            self._accumulate(t, d, -1)
+            self._n -= 1
+
+    def result(self):
+        n = self._n
+        if n < 2:
+            return 0.0, 0, 0.0
+
+        s_xy = n * self._s_td - self._s_t * self._s_d
+        s_xx = n * self._s_tt - self._s_t * self._s_t
+        s_yy = n * self._s_dd - self._s_d * self._s_d
+        if s_xx <= 0:
+            return 0.0, n, 0.0
+        slope = s_xy / s_xx
+        r_value = s_xy / math.sqrt(s_xx * s_yy) if s_yy > 0 else 0.0
+        r_value = max(-1.0, min(1.0, r_value))
+
+        return slope, n, r_value  # rate in mm/s, number of samples used, r_value
+
+
+class WeightedAverage:
+    """Weighted mean of the last `size` (value, weight) pairs, updated in O(1) per pair.
+
+    The pairs live in two parallel arrays of doubles used as a ring. Like
+    RollingRegression, the running sums are rebuilt from them every 10 * size
+    appends so floating-point drift cannot accumulate.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._values = array("d", bytes(8 * size))
+        self._weights = array("d", bytes(8 * size))
+        self._head = 0  # slot the next pair is written to
+        self._count = 0
+        self._resync_interval = 10 * size
+        self._until_resync = self._resync_interval
+        self._w_sum = self._vw_sum = 0.0
 
-HOST = "http://localhost"
-INFLUX_HELPER = "/home/pi/devs/zhopper/influx_write_by_line.py"
-INFLUX_BUCKET = "gantry"
-INFLUX_MEASUREMENT = "gantry"
-INTERVAL = 1  # seconds
-SAMPLES_SHORTTERM = 60  # number of samples to use for calculating a rate
-SAMPLES_MIDTERM = 120  # number of samples to use for mid-term rate
-SAMPLES_LONGTERM = 240 #number of samples to use for long-term rate
-NUMBER_OF_RATES = 20 #number of calculated short-term rates to average
+    def __len__(self):
+        return self._count
 
+    def append(self, value, weight):
+        i = self._head
+        if self._count == self.size:
+            self._w_sum -= self._weights[i]
+            self._vw_sum -= self._values[i] * self._weights[i]
+        else:
+            self._count += 1
+        self._values[i] = value
+        self._weights[i] = weight
+        self._head = (i + 1) % self.size
+        self._w_sum += weight
+        self._vw_sum += value * weight
+        self._until_resync -= 1
+        if not self._until_resync:
+            self._until_resync = self._resync_interval
+            # Unused slots are still zero, so summing whole arrays is fine.
+            self._w_sum = sum(self._weights)
+            self._vw_sum = sum(map(operator.mul, self._values, self._weights))
 
-# Rolling buffer of (timestamp, distance) tuples
-samples = deque(maxlen=SAMPLES_LONGTERM)
-rate_samples_shortterm = deque(maxlen=NUMBER_OF_RATES)  # store (rate, weight)
+    def mean(self):
+        """Return the weighted mean, or 0.0 if there is no weight."""
+        return self._vw_sum / self._w_sum if self._w_sum > 0 else 0.0
 
 
 # Helper to open file for r/w, creating if needed, and initialize with "0\n" if new. 
 # We do not want to ever have an empty file, as klipper seems not to recover when
-# trying to read from it.
+# trying to read from it. Yields a raw file descriptor, closed on exit.
+@contextmanager
 def open_or_create_file(path):
     if not os.path.exists(path):
         with open(path, "w") as f:
             f.write("0\n")
-    return open(path, "r+")
+    fd = os.open(path, os.O_RDWR)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+
+
+# Just the path to the one value we need from Moonraker's reply to
+# /printer/objects/query?beacon; msgspec skips every other field while decoding.
+class BeaconSample(msgspec.Struct):
+    dist: float | None = None
+
+class Beacon(msgspec.Struct):
+    last_received_sample: BeaconSample | None = None
+
+class BeaconStatus(msgspec.Struct):
+    beacon: Beacon
 
+class BeaconResult(msgspec.Struct):
+    status: BeaconStatus
 
+class BeaconQuery(msgspec.Struct):
+    result: BeaconResult
 
+_beacon_query_decoder = msgspec.json.Decoder(BeaconQuery)
 
-def get_distance(quiet):
+async def get_distance(session, host, quiet):
     try:
-        resp = requests.get(f"{HOST}/printer/objects/query?beacon", timeout=2)
-        resp.raise_for_status()
-        data = resp.json()
-        sample = data["result"]["status"]["beacon"].get("last_received_sample")
-        if not sample or "dist" not in sample:
+        async with session.get(f"{host}/printer/objects/query?beacon",
+                               timeout=aiohttp.ClientTimeout(total=2)) as resp:
+            resp.raise_for_status()
+            body = await resp.read()
+        sample = _beacon_query_decoder.decode(body).result.status.beacon.last_received_sample
+        if sample is None or sample.dist is None:
             log_error("dist not in last_received_sample", quiet)
             return None
-        return float(sample["dist"])
+        return sample.dist
     except Exception as e:
         log_error(f"Error querying distance: {e}", quiet)
         return None
 
-def compute_rate(samples):
-    if len(samples) < 2:
-        return 0.0, 0, 0.0
+def format_rate(rate_in_mm_per_s):
+    rate_pm_s = round(rate_in_mm_per_s * 1e9)
+    rate_shifted = rate_pm_s + 100000
+    rate_limited = max(-273000, min(rate_shifted, 200000))
+    return b"%9d\n" % rate_limited
 
-    times = [s[0] - samples[0][0] for s in samples]  # relative times
-    dists = [s[1] for s in samples]
+class RecordFile:
+    """An output file descriptor, rewritten in place with fixed-width records.
 
-    slope, intercept, r_value, p_value, std_err = linregress(times, dists)
-#    print(f"SciPy slope   : {slope * 1e6:.2f} nm/s (R² = {r_value**2:.4f})")
+    Every record is the same width, so one pwrite at offset 0 replaces the
+    whole file. No flush or fsync is needed: readers see the page cache
+    directly. A record identical to the last one written is skipped.
+    """
 
-    # # Compare to endpoint slope
-    # dt = times[-1] - times[0]
-    # dd = dists[-1] - dists[0]
-    # endpoint_slope = dd / dt if dt else 0.0
-    # print(f"Endpoint slope: {endpoint_slope * 1e6:.2f} nm/s")
+    def __init__(self, fd):
+        self.fd = fd
+        self._last = None
 
-    return slope, len(samples), r_value  # rate in mm/s, number of samples used, r_value
+    def write(self, output):
+        if output == self._last:
+            return
+        os.pwrite(self.fd, output, 0)
+        self._last = output
 
-def write_rate_to_file(file_handle, rate_in_mm_per_s):
+def write_rate_to_file(record_file, rate_in_mm_per_s):
     try:
-        rate_pm_s = round(rate_in_mm_per_s * 1e9)
-        rate_shifted = rate_pm_s + 100000
-        rate_limited = max(-273000, min(rate_shifted, 200000))
-        file_handle.seek(0)
-        output = f"{rate_limited:9d}\n"
-        file_handle.write(output)
-        file_handle.flush()
+        record_file.write(format_rate(rate_in_mm_per_s))
+    except Exception as e:
+        print(f"Failed to write to file: {e}", file=sys.stderr)
+
+# Combined status file: one line per rate, in the order they are given.
+def write_rates_to_file(record_file, rates_in_mm_per_s):
+    try:
+        record_file.write(b"".join(map(format_rate, rates_in_mm_per_s)))
     except Exception as e:
         print(f"Failed to write to file: {e}", file=sys.stderr)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Ratemeter daemon")
+    parser.add_argument("--config", help="JSON file overriding the default settings")
     parser.add_argument("--log", action="store_true", help="Print log line with rates and details")
     parser.add_argument("--influxdb", action="store_true", help="Enable writing to InfluxDB")
     parser.add_argument("--quiet", action="store_true", help="Suppress error logging")
-    return parser.parse_args()
-
-def main(args):
-    with open_or_create_file(FILE_SHORTTERM) as f_short, \
-         open_or_create_file(FILE_MIDTERM) as f_mid, \
-         open_or_create_file(FILE_LONGTERM) as f_long, \
-         open_or_create_file(FILE_SMOOTHED) as f_smooth:
-        recent_dists = deque(maxlen=5)
-        averaged_dists = []
-        while True:
-            now = time.time()
-            dist = get_distance(args.quiet)
-            if dist is not None:
-                samples.append((now, dist))
-                recent_dists.append(dist)
-                if len(recent_dists) == 5:
-                    dist_avg = mean(recent_dists)
-                    if args.influxdb:
-                        line = f"{INFLUX_MEASUREMENT} distance={dist_avg:.6f} {int(now * 1e9)}"
-                        try:
-                            subprocess.run(
-                                ["python3", INFLUX_HELPER, "--bucket", INFLUX_BUCKET],
-                                input=line.encode("utf-8"),
-                                check=True
-                            )
-                        except Exception as e:
-                            print(f"Error calling influx_write_by_line.py: {e}", file=sys.stderr)
-                    recent_dists.clear()
-                if len(samples) >= 5:
-                    shortterm_samples = list(samples)[-SAMPLES_SHORTTERM:]
-                    midterm_samples = list(samples)[-SAMPLES_MIDTERM:]
-                    rate_short, count_short, r_short = compute_rate(shortterm_samples)
-                    rate_mid, count_mid, r_mid = compute_rate(midterm_samples)
-                    rate_long, count_long, r_long = compute_rate(samples)
-                    weight = count_short / SAMPLES_SHORTTERM
-                    rate_samples_shortterm.append((rate_short, weight))
-                    if len(rate_samples_shortterm) > 0:
-                        total_weight = sum(w for _, w in rate_samples_shortterm)
-                        if total_weight > 0:
-                            avg_rate = sum(r * w for r, w in rate_samples_shortterm) / total_weight
-                        else:
-                            avg_rate = 0.0
-                        if args.log:
-                            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} dist={dist:.6f} "
-                                  f"rate_short={rate_short*1e6:.2f} r2_short={r_short**2:.4f} "
-                                  f"rate_mid={rate_mid*1e6:.2f} r2_mid={r_mid**2:.4f} "
-                                  f"rate_long={rate_long*1e6:.2f} r2_long={r_long**2:.4f} "
-                                  f"avg_rate={avg_rate*1e6:.2f} nm/s")
-                    write_rate_to_file(f_short, rate_short)
-                    write_rate_to_file(f_mid, rate_mid)
-                    write_rate_to_file(f_long, rate_long)
-                    write_rate_to_file(f_smooth, avg_rate)
-            else: #there is no data to process, so let us clen up the existing samples
-                cutoff = now - 240  # 4 minutes
-                while samples and samples[0][0] < cutoff:
-                    samples.popleft()
-            elapsed = time.time() - now
-            sleep_duration = max(0, INTERVAL - elapsed)
-            time.sleep(sleep_duration)
+    parser.add_argument("--influx-stdin-loop", action="store_true",
+                        help="Feed one long-running InfluxDB helper instead of one run per record")
+    parser.add_argument("--combined", action="store_true",
+                        help="Write all rates to one status file instead of one file each")
+    args = parser.parse_args()
+    try:
+        config = Config.from_json(args.config) if args.config else Config()
+    except (OSError, ValueError, TypeError) as e:
+        parser.error(f"cannot load config {args.config}: {e}")
+    config.log |= args.log
+    config.influxdb |= args.influxdb
+    config.quiet |= args.quiet
+    config.combined_output |= args.combined
+    config.influx_stdin_loop |= args.influx_stdin_loop
+    return config
+
+# A looping helper that dies within INFLUX_HELPER_STABLE seconds of starting is
+# restarted after INFLUX_RESTART_BACKOFF seconds, doubling each time; after
+# INFLUX_RESTART_LIMIT such exits in a row, InfluxDB output is switched off.
+INFLUX_HELPER_STABLE = 600.0
+INFLUX_RESTART_BACKOFF = 5.0
+INFLUX_RESTART_LIMIT = 5
+
+class InfluxWriter:
+    """Sends line-protocol records to the InfluxDB helper script.
+
+    By default the helper is run once per record, as the daemon always did.
+    With config.influx_stdin_loop it is started once with --stdin-loop and fed
+    one record per line on stdin, so its interpreter start-up is paid once.
+    A looping helper that exits is restarted with exponential backoff,
+    dropping records meanwhile, and given up on if it keeps dying. One that
+    exits with argparse's status 2 lacks the flag, and the writer falls back
+    to running it once per record.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._proc = None  # the looping helper, None in once-per-record mode
+        self._started = 0.0  # monotonic time the looping helper was last spawned
+        self._exited_at = None  # monotonic time it exited, set by _watch()
+        self._watcher = None
+        self._quick_exits = 0
+        self._restart_at = None  # when to respawn an exited helper, once scheduled
+        self._disabled = False
+
+    def _command(self, *extra):
+        return ("python3", self.config.influx_helper, "--bucket", self.config.influx_bucket, *extra)
+
+    async def _spawn_loop(self):
+        self._proc = await asyncio.create_subprocess_exec(
+            *self._command("--stdin-loop"), stdin=asyncio.subprocess.PIPE)
+        self._started = time.monotonic()
+        self._exited_at = None
+        self._watcher = asyncio.create_task(self._watch(self._proc))
+
+    async def _watch(self, proc):
+        # Note the exit time as it happens: records can be minutes apart, so
+        # noticing the exit on the next write says little about how long it ran.
+        await proc.wait()
+        self._exited_at = time.monotonic()
+
+    async def start(self):
+        if self.config.influx_stdin_loop:
+            await self._spawn_loop()
+
+    async def close(self):
+        if self._proc is None or self._proc.returncode is not None:
+            return
+        self._proc.stdin.close()
+        try:
+            await asyncio.wait_for(self._proc.wait(), 5)
+        except asyncio.TimeoutError:
+            self._proc.kill()
+            await self._proc.wait()
+
+    async def _write_once(self, data):
+        proc = await asyncio.create_subprocess_exec(*self._command(), stdin=asyncio.subprocess.PIPE)
+        await proc.communicate(data)
+        if proc.returncode:
+            raise RuntimeError(f"exited with {proc.returncode}")
+
+    async def _restart(self):
+        """Respawn the exited looping helper; False while backing off or once given up."""
+        now = time.monotonic()
+        if self._proc.returncode == 2:
+            # argparse's usage error: this helper does not know --stdin-loop.
+            log_error(f"{self.config.influx_helper} does not accept --stdin-loop, "
+                      "running it once per record instead", self.config.quiet)
+            self._proc = None
+            return True
+        if self._restart_at is None:
+            # First record since the helper exited: decide when to restart it.
+            exited_at = self._exited_at if self._exited_at is not None else now
+            if exited_at - self._started >= INFLUX_HELPER_STABLE:
+                self._quick_exits = 0
+            self._quick_exits += 1
+            if self._quick_exits > INFLUX_RESTART_LIMIT:
+                self._disabled = True
+                log_error(f"{self.config.influx_helper} keeps exiting (last with "
+                          f"{self._proc.returncode}), disabling InfluxDB output", self.config.quiet)
+                return False
+            delay = INFLUX_RESTART_BACKOFF * 2 ** (self._quick_exits - 1)
+            self._restart_at = now + delay
+            log_error(f"{self.config.influx_helper} exited with {self._proc.returncode}, "
+                      f"restarting in {delay:.0f} s and dropping records until then", self.config.quiet)
+        if now < self._restart_at:
+            return False
+        self._restart_at = None
+        await self._spawn_loop()
+        return True
+
+    async def write(self, line):
+        if self._disabled:
+            return
+        data = line.encode("utf-8")
+        try:
+            if self._proc is not None and self._proc.returncode is not None:
+                if not await self._restart():
+                    return
+            if self._proc is None:
+                await self._write_once(data.rstrip(b"\n"))
+                return
+            self._proc.stdin.write(data)
+            await self._proc.stdin.drain()
+        except Exception as e:
+            log_error(f"Error writing to influx_write_by_line.py: {e}", self.config.quiet)
+
+class Ratemeter:
+    """The daemon's rate state, fed one polled distance per tick."""
+
+    def __init__(self, config, files, influx):
+        self.config = config
+        self.files = files  # RecordFiles for (shortterm, midterm, longterm, smoothed) or (status,)
+        self.influx = influx  # InfluxWriter, or None when InfluxDB output is off
+        # Rolling buffer of the latest samples, and a fit over it for each rate window
+        self.samples = SampleRing(config.samples_longterm + 1)
+        self.regression_shortterm = RollingRegression(self.samples, config.samples_shortterm)
+        self.regression_midterm = RollingRegression(self.samples, config.samples_midterm)
+        self.regression_longterm = RollingRegression(self.samples, config.samples_longterm)
+        self.rate_samples_shortterm = WeightedAverage(config.number_of_rates)  # short-term (rate, weight)
+        self.recent_dists = deque(maxlen=5)
+
+    async def process_sample(self, now, wall_ns, dist):
+        config = self.config
+        if dist is not None:
+            self.samples.append(now, dist)
+            self.regression_shortterm.update()
+            self.regression_midterm.update()
+            self.regression_longterm.update()
+            self.recent_dists.append(dist)
+            if len(self.recent_dists) == 5:
+                dist_avg = fmean(self.recent_dists)
+                if self.influx is not None:
+                    line = f"{config.influx_measurement} distance={dist_avg:.6f} {wall_ns}\n"
+                    await self.influx.write(line)
+                self.recent_dists.clear()
+            if len(self.regression_longterm) >= 5:
+                rate_short, count_short, r_short = self.regression_shortterm.result()
+                rate_mid, count_mid, r_mid = self.regression_midterm.result()
+                rate_long, count_long, r_long = self.regression_longterm.result()
+                weight = count_short / config.samples_shortterm
+                self.rate_samples_shortterm.append(rate_short, weight)
+                if len(self.rate_samples_shortterm) > 0:
+                    avg_rate = self.rate_samples_shortterm.mean()
+                    if config.log:
+                        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} dist={dist:.6f} "
+                              f"rate_short={rate_short*1e6:.2f} r2_short={r_short**2:.4f} "
+                              f"rate_mid={rate_mid*1e6:.2f} r2_mid={r_mid**2:.4f} "
+                              f"rate_long={rate_long*1e6:.2f} r2_long={r_long**2:.4f} "
+                              f"avg_rate={avg_rate*1e6:.2f} nm/s")
+                rates = (rate_short, rate_mid, rate_long, avg_rate)
+                if config.combined_output:
+                    write_rates_to_file(self.files[0], rates)
+                else:
+                    for record_file, rate in zip(self.files, rates):
+                        write_rate_to_file(record_file, rate)
+        else: #there is no data to process, so let us clen up the existing samples
+            # Drop samples older than the long-term window spans in time
+            cutoff = now - config.samples_longterm * config.interval
+            self.regression_shortterm.evict_before(cutoff)
+            self.regression_midterm.evict_before(cutoff)
+            self.regression_longterm.evict_before(cutoff)
+
+async def main(config):
+    names = ("status",) if config.combined_output else ("shortterm", "midterm", "longterm", "smoothed")
+    async with AsyncExitStack() as stack:
+        files = tuple(RecordFile(stack.enter_context(open_or_create_file(config.output_file(name))))
+                      for name in names)
+        influx = None
+        if config.influxdb:
+            influx = InfluxWriter(config)
+            await influx.start()
+            stack.push_async_callback(influx.close)
+        ratemeter = Ratemeter(config, files, influx)
+        # One session for the daemon's lifetime keeps the HTTP connection alive.
+        # Only one request is ever in flight, so a single pooled connection is
+        # enough and every tick reuses the same socket.
+        connector = aiohttp.TCPConnector(limit=1)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Sample timestamps are seconds on the monotonic clock since start-up,
+            # taken from integer nanoseconds so they stay exact and small; the
+            # wall clock is only read for the InfluxDB records.
+            start_ns = time.monotonic_ns()
+            # Ticks are scheduled against absolute deadlines so the time spent
+            # working does not stretch the sampling period.
+            deadline_ns = start_ns
+            interval_ns = round(config.interval * 1e9)
+            previous = None  # (timestamp, wall clock ns, distance) of the previous tick
+            while True:
+                now_ns = time.monotonic_ns()
+                wall_ns = time.time_ns()
+                # Process the previous sample while this tick's request is in flight.
+                http_task = asyncio.create_task(get_distance(session, config.host, config.quiet))
+                if previous is not None:
+                    compute_task = asyncio.create_task(ratemeter.process_sample(*previous))
+                    await asyncio.gather(http_task, compute_task)
+                previous = ((now_ns - start_ns) * 1e-9, wall_ns, await http_task)
+                deadline_ns += interval_ns
+                sleep_ns = deadline_ns - time.monotonic_ns()
+                if sleep_ns > 0:
+                    await asyncio.sleep(sleep_ns * 1e-9)
+                else:
+                    # Overran the tick (e.g. a request timing out): carry on from
+                    # now rather than firing a burst of ticks to catch up.
+                    deadline_ns -= sleep_ns
 
 if __name__ == "__main__":
-    args = parse_args()
-    main(args)
\ No newline at end of file
+    config = parse_args()
+    asyncio.run(main(config))